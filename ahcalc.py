@@ -1,12 +1,35 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # coding: utf-8
 
 # (C) Alex Hurst, 2015
 
+import decimal
+import functools
 import math
 import operator
-import re
-import string
+import sys
+
+# Characters which make up a number. Whitespace and commas are discarded
+# wherever they appear, so '1,000' and '1 000' both read as 1000.
+_NUMBER_CHARS = frozenset('0123456789.')
+
+# Easy way to convert negative numbers into a compatible form for
+# parsing. A hyphen at the start of the string, start of brackets, or
+# after another operator is replaced with these tokens, like this:
+# -5+6 becomes (0-1)*5+6
+# (-5+6) becomes ((0-1)*5+6)
+# 5*-6 becomes 5*(0-1)*6
+# -(1+2) becomes (0-1)*(1+2)
+_NEGATION_TOKENS = ['(', 0.0, '-', 1.0, ')', '*']
+_NEGATION_CONTEXT = frozenset(['+', '-', '*', '/', '('])
+
+# The largest number ahcalc will take the factorial of. Much larger
+# factorials take a long time to work out, and a lot of memory to hold.
+_MAX_FACTORIAL = 1000
+
+# The classes a number in a program can have: floats read from the
+# input, and the exact integers that factorials produce.
+_NUMBER_CLASSES = frozenset([float, int])
 
 
 def tokenize(input_string):
@@ -16,247 +39,388 @@ def tokenize(input_string):
     arithmetic notation. Clean it up to a list of numbers, operators,
     and brackets. Make appropriate modifications for various kinds of
     notation: implied multiplication, negative numbers, different styles
-    of brackets, negative parentheses, and nested parentheses."""
-
-    # Validate for illegal characters
-    if re.search(r'''[^0-9\.,\+\-\*/\(\)\[\]\!\^\s]''',
-                 input_string, re.VERBOSE):
-        raise(ValueError(
-              "The only allowable characters are 0-9, +, -, *, /, !, "
-              "^, ., comma, parentheses, and square brackets."))
-        return
+    of brackets, negative parentheses, and nested parentheses.
+
+    The input is scanned once, left to right, validating and emitting
+    tokens as it goes. Errors report the position of the offending
+    character where there is one."""
+
+    tokens = []
+    paren_depth = 0
+    bracket_depth = 0
+    prev_char = None
+
+    # Where the number being read started. Numbers are sliced out of the
+    # input whole once they end, and converted with a single float().
+    number_start = None
+
+    # Where the last negation lookahead stopped, and whether it found an
+    # operand there. Every hyphen in a run like '---5' shares the answer.
+    negation_end = 0
+    negates = False
+
+    for position, char in enumerate(input_string, 1):
+        if char in _NUMBER_CHARS:
+            if number_start is None:
+                number_start = position - 1
+            continue
+        elif char.isspace() or char == ',':
+            continue
+
+        if number_start is not None:
+            _push_number(tokens, input_string[number_start:position - 1])
+            number_start = None
+            prev_char = None
+
+        if char == '(' or char == '[':
+            if char == '(':
+                paren_depth += 1
+            else:
+                bracket_depth += 1
+
+            # Regularize multiplication in the form
+            # 2(3+4) or  (2+3)(4+5) into the form
+            # 2*(3+4) or (2+3)*(4+5)
+            if tokens and (tokens[-1].__class__ is float or tokens[-1] == ')'):
+                tokens.append('*')
+            tokens.append('(')
+
+        elif char == ')' or char == ']':
+            if char == ')':
+                paren_depth -= 1
+            else:
+                bracket_depth -= 1
+            if paren_depth < 0 or bracket_depth < 0:
+                raise(ValueError(
+                      "Unbalanced brackets or parentheses: '%s' at "
+                      "position %d closes nothing." % (char, position)))
+            tokens.append(')')
+
+        elif char == '*' and prev_char == '*':
+            # Accept '**', which is equivalent to '^'. Convert it to '^'
+            # for standard handling.
+            tokens[-1] = '^'
+            char = '^'
+
+        elif char == '-' and (not tokens or tokens[-1] in _NEGATION_CONTEXT):
+            if position > negation_end:
+                negation_end, negates = _negates_operand(input_string,
+                                                         position)
+            if negates:
+                tokens.extend(_NEGATION_TOKENS)
+            else:
+                tokens.append(char)
+
+        elif char in '+-*/!^':
+            tokens.append(char)
+
+        else:
+            raise(ValueError(
+                  "Invalid character '%s' at position %d. The only "
+                  "allowable characters are 0-9, +, -, *, /, !, ^, ., "
+                  "comma, parentheses, and square brackets."
+                  % (char, position)))
 
-    # Validate for unbalanced brackets
-    if (input_string.count('(') != input_string.count(')') or
-            input_string.count('[') != input_string.count(']')):
+        prev_char = char
 
+    if number_start is not None:
+        _push_number(tokens, input_string[number_start:])
+
+    if paren_depth != 0 or bracket_depth != 0:
         raise(ValueError("Unbalanced brackets or parentheses."))
 
-    regularized_string = re.sub(r'[\s,]', '', input_string)
-    regularized_string = regularized_string.translate(
-        string.maketrans('[]', '()'))
-
-    # Accept '**', which is equivalent to '^'. Convert it to '^' for standard
-    # handling.
-
-    regularized_string = re.sub(r'''\*\*''',
-                                r'''^''',
-                                regularized_string)
-
-    # Easy way to convert negative numbers into a compatible form for
-    # parsing. Convert hyphen-number at the start of the string, start
-    # of brackets, or after another operator strings like this:
-    # -5+6 becomes (0-1)*5+6
-    # (-5+6) becomes ((0-1)*5+6)
-    # 5*-6 becomes 5*(0-1)*6
-
-    neg_at_start_regex = re.compile(r'''(^ - ([\d\.,]+) )''', re.X)
-    neg_after_op_regex = re.compile(r'''((?<=[-+*/(]) - ([\d\.,]+) )''', re.X)
-
-    regularized_string = re.sub(neg_at_start_regex,
-                                r'''(0-1)*\2''', regularized_string)
-    regularized_string = re.sub(neg_after_op_regex,
-                                r'''(0-1)*\2''', regularized_string)
-
-    # Similar way to convert negative parentheses into a compatible form
-    # for parsing. Convert '-(' in places where it signifies a negative:
-    # -(1+2) becomes (0-1)*(1+2)
-
-    regularized_string = re.sub(r'''^-(\()''',
-                                r'''(0-1)*\1''',
-                                regularized_string)
-
-    regularized_string = re.sub(r'''(?<=[-+*/(])-(\()''',
-                                r'''(0-1)*\1''',
-                                regularized_string)
-
-    # Regularize multiplication in the form
-    # 2(3+4),  (2+3)4, or  (2+3)(4+5) into the form
-    # 2*(3+4), (2+3)*4, or (2+3)*(4+5)
-    regularized_string = re.sub(r'''(\d)(\()''', r'''\1*\2''',
-                                regularized_string)
-    regularized_string = re.sub(r'''(\))(\d)''', r'''\1*\2''',
-                                regularized_string)
-    regularized_string = re.sub(r'''(\))(\()''', r'''\1*\2''',
-                                regularized_string)
-
-    tokenized_input = re.split(r'''([^\d\.,])''', regularized_string,
-                               re.VERBOSE)
-
-    # re.split creates unwanted null values when the split pattern
-    # occurs at the end of the string (close brackets and !.)
-    while '' in tokenized_input:
-        tokenized_input.remove('')
-
-    tokenized_input_cast = []
-    for token in tokenized_input:
-        try:
-            token_cast = float(token)
-        except ValueError:
-            token_cast = token
+    return tokens
 
-        tokenized_input_cast.append(token_cast)
 
-    return tokenized_input_cast
+def _negates_operand(input_string, position):
+    """Tell whether a '-' just before position has anything to negate.
 
+    Only a number or a bracketed group can be negated, possibly through
+    further hyphens: '--5' is 5. A hyphen followed by anything else is
+    left as a minus sign, so that its error message names it.
 
-def buildtree(tokens):
-    """Parse a list of tokens into an evaluable tree.
+    Return the position the lookahead stopped at along with the answer,
+    which holds for every hyphen before that position."""
 
-    Convert a list of tokens (as prepared by ahcalc.tokenize())
-    into a nested tree of binary or unary functions and their arguments.
-    Recursively process the list to accommodate arbitrarily nested
-    parentheses. Process operators in the correct order to respect
-    normal arithmetical order of operation."""
-
-    math_funcs = {'^': pow,
-                  '+': operator.add,
-                  '-': operator.sub,
-                  '!': math.factorial,
-                  '*': operator.mul,
-                  '/': operator.div}
-    tree = tokens[:]
-
-    # Recursive case: there is at least one level of nested parentheses
-    # to process.
-    while '(' in tree:
-
-        paren_start = tree.index('(')
-        depth = 0
-
-        for i, token in enumerate(tree[paren_start:]):
-            if token == '(':
-                depth += 1
-            elif token == ')':
-                depth -= 1
-            if depth == 0:
-                paren_len = i
-                break
-
-        # The for loop never hit a break, which means we didn't find a
-        # matching close parenthesis.
-        else:
-            raise(ValueError("Unmatched parentheses."))
+    while position < len(input_string):
+        char = input_string[position]
+        if char in _NUMBER_CHARS or char == '(' or char == '[':
+            return position, True
+        elif not (char.isspace() or char == ',' or char == '-'):
+            return position, False
+        position += 1
+    return position, False
 
-        paren_end = paren_start + paren_len
 
-        # recursion magic: support arbitrarily deeply nested sets of
-        # parentheses
-        tree[paren_start:paren_end+1] = \
-            [buildtree(tree[paren_start+1 : paren_end])]
+def _push_number(tokens, text):
+    """Append the number spelled by text to tokens."""
 
-    # Base case: there are no parentheses in this list, and we can group
-    # the other operators and return the tree.
+    try:
+        value = float(text)
+    except ValueError:
+        # float() copes with whitespace around a number, but not with
+        # whitespace or commas inside it.
+        digits = ''.join(text.replace(',', ' ').split())
+        try:
+            value = float(digits)
+        except ValueError:
+            raise(ValueError("Invalid number: %s" % digits))
+
+    # Regularize multiplication in the form (2+3)4 into (2+3)*4
+    if tokens and tokens[-1] == ')':
+        tokens.append('*')
+    tokens.append(value)
+
+
+def _factorial(x):
+    """Return the exact factorial of a number with a whole-number value.
+
+    Refuse anything larger than _MAX_FACTORIAL up front, rather than
+    spending seconds and megabytes working out its factorial."""
+
+    # Factorials are exact integers already. Of the floats which are not
+    # whole, infinity is merely too large.
+    if x < 0 or (x.__class__ is float and not x.is_integer()
+                 and x != math.inf):
+        raise(ValueError("Factorial is only defined for whole numbers."))
+    if x > _MAX_FACTORIAL:
+        raise(OverflowError("Factorial result too large."))
+    return math.factorial(int(x))
+
+
+def _power(x, y):
+    """Raise x to the power y, staying within the real numbers."""
+
+    # Infinite and not-a-number exponents are left to Python, which gives
+    # the limit: (-2)^inf is inf.
+    if (x < 0 and y.__class__ is float and math.isfinite(y)
+            and not y.is_integer()):
+        raise(ValueError("Negative numbers cannot be raised to a "
+                         "fractional power."))
+
+    # An exact integer power of a factorial, such as (100!)^(100!), can
+    # take practically forever. A float power overflows straight away.
+    if y.__class__ is int:
+        y = float(y)
+    return x ** y
+
+
+_OPS = {'^': _power,
+        '+': operator.add,
+        '-': operator.sub,
+        '!': _factorial,
+        '*': operator.mul,
+        '/': operator.truediv}
+
+# Binary operators of equal precedence are grouped left to right,
+# including '^': 2^3^2 is (2^3)^2.
+_PRECEDENCE = {'^': 3,
+               '*': 2,
+               '/': 2,
+               '+': 1,
+               '-': 1}
+
+_OPERATOR_ERRORS = {'!': "Factorial without an appropriate group or number "
+                         "preceding it.",
+                    '^': "Exponent without appropriate groups or numbers "
+                         "before and after it.",
+                    '*': "* or / without appropriate groups or numbers "
+                         "before and after it.",
+                    '/': "* or / without appropriate groups or numbers "
+                         "before and after it.",
+                    '+': "+ or - without appropriate groups or numbers "
+                         "before and after it.",
+                    '-': "+ or - without appropriate groups or numbers "
+                         "before and after it."}
 
-    while '!' in tree:
-        fact_idx = tree.index('!')
-        if type(tree[fact_idx-1]) not in [float, list] or fact_idx == 0:
-            raise(ValueError(
-                  "Factorial without an appropriate group or number "
-                  "preceding it."))
-        else:
-            tree[fact_idx-1 : fact_idx+1] = \
-                [[math_funcs['!'], tree[fact_idx-1]]]
-
-    while '^' in tree:
-        exp_idx = tree.index('^')
-        if (exp_idx in [0, len(tree)-1]
-                or type(tree[exp_idx-1]) not in [float, list]
-                or type(tree[exp_idx+1]) not in [float, list]):
-            raise(ValueError(
-                  "Exponent without appropriate groups or numbers "
-                  "before and after it."))
-        tree[exp_idx-1 : exp_idx+2] = \
-            [[math_funcs['^'], tree[exp_idx-1], tree[exp_idx+1]]]
-
-    while ('*' in tree) or ('/' in tree):
-
-        # Which operator did we catch?
-        # If multiple, select the first one.
-        if '*' in tree and '/' in tree:
-            muldiv_idx = min(tree.index('*'), tree.index('/'))
-        elif '/' in tree:
-            muldiv_idx = tree.index('/')
-        elif '*' in tree:
-            muldiv_idx = tree.index('*')
-        else:
-            raise(ValueError("How did we reach this point in the code?"))
-
-        # Consume the first * or / and replace with a sub-expression of
-        # it with its arguments.
-        muldiv_char = tree[muldiv_idx]
-        if (muldiv_idx in [0, len(tree)-1]
-            or type(tree[muldiv_idx - 1]) not in [float, list]
-            or type(tree[muldiv_idx + 1]) not in [float, list]):
+
+def buildtree(tokens):
+    """Parse a list of tokens into an evaluable program.
+
+    Convert a list of tokens (as prepared by ahcalc.tokenize())
+    into a flat list of numbers and the unary or binary functions to
+    apply to them, in postfix (reverse Polish) order. Walk the list once
+    with the shunting-yard algorithm, holding pending operators on a
+    stack, to accommodate arbitrarily nested parentheses without
+    recursion. Process operators in the correct order to respect normal
+    arithmetical order of operation."""
+
+    program = []
+    operators = []
+    expect_operand = True
+
+    for token in tokens:
+        if token.__class__ is float or token == '(':
+            if not expect_operand:
                 raise(ValueError(
-                      "* or / without appropriate groups or numbers "
-                      "before and after it."))
-        tree[muldiv_idx-1 : muldiv_idx+2] = \
-            [[math_funcs[muldiv_char],
-                tree[muldiv_idx-1], tree[muldiv_idx+1]]]
-
-    while ('+' in tree) or ('-' in tree):
-
-        # Which operator did we catch?
-        # If multiple, select the first one.
-        if '+' in tree and '-' in tree:
-            addsub_idx = min(tree.index('+'), tree.index('-'))
-        elif '+' in tree:
-            addsub_idx = tree.index('+')
-        elif '-' in tree:
-            addsub_idx = tree.index('-')
+                      "Missing operator between numbers or groups."))
+            if token == '(':
+                operators.append(token)
+            else:
+                program.append(token)
+                expect_operand = False
+
+        elif token == ')':
+            if expect_operand and operators:
+                if operators[-1] in _OPERATOR_ERRORS:
+                    raise(ValueError(_operator_error(tokens, operators[-1])))
+                raise(ValueError("Empty parentheses."))
+
+            # Group everything back to the matching open parenthesis
+            # into a single operand.
+            while operators and operators[-1] != '(':
+                _emit(program, _OPS[operators.pop()])
+            if not operators:
+                raise(ValueError("Unmatched parentheses."))
+            operators.pop()
+
+        elif token == '!':
+            # Factorial binds tighter than everything else, so it can be
+            # applied to the preceding number or group straight away.
+            if expect_operand:
+                raise(ValueError(_operator_error(tokens, token)))
+            _emit(program, _OPS['!'])
+
         else:
-            raise(ValueError("How did we reach this point in the code?"))
-
-        # Consume the first + or - and replace with a sub-expression of
-        # it with its arguments.
-        addsub_char = tree[addsub_idx]
-        if (addsub_idx in [0, len(tree)-1]
-            or type(tree[addsub_idx-1]) not in [float, list]
-            or type(tree[addsub_idx+1]) not in [float, list]):
-                raise(ValueError(
-                      "+ or - without appropriate groups or numbers "
-                      "before and after it."))
-        tree[addsub_idx-1 : addsub_idx+2] = \
-            [[math_funcs[addsub_char],
-                tree[addsub_idx-1], tree[addsub_idx+1]]]
+            if expect_operand:
+                raise(ValueError(_operator_error(tokens, token)))
+
+            # Emit any pending operators which bind at least as tightly
+            # as this one, so that they apply to the arguments already
+            # in the program.
+            while (operators and operators[-1] != '('
+                   and _PRECEDENCE[operators[-1]] >= _PRECEDENCE[token]):
+                _emit(program, _OPS[operators.pop()])
+            operators.append(token)
+            expect_operand = True
+
+    if expect_operand:
+        if operators and operators[-1] in _OPERATOR_ERRORS:
+            raise(ValueError(_operator_error(tokens, operators[-1])))
+        raise(ValueError("Nothing to calculate."))
+
+    while operators:
+        operator_char = operators.pop()
+        if operator_char == '(':
+            raise(ValueError("Unmatched parentheses."))
+        _emit(program, _OPS[operator_char])
 
     # We have consumed all the operators in order of precedence,
-    # and at the end there's a nicely-arranged tree we can pass to
+    # and at the end there's a nicely-arranged program we can pass to
     # evaltree.
-    return tree
+    return program
+
+
+def _operator_error(tokens, operator_char):
+    """Return the error message for an operator missing its operands.
+
+    buildtree() notices the first operator, left to right, which is
+    missing an operand, but the error names the one that grouping
+    operators by precedence would trip over first: in '+*5' that is the
+    '*'. Groups are checked in the order they close, then the whole
+    expression. operator_char is blamed if no other operator is."""
+
+    groups = [[]]
+    for token in tokens:
+        if token == '(':
+            groups.append([])
+        elif token == ')' and len(groups) > 1:
+            blamed = _misplaced_operator(groups.pop())
+            if blamed:
+                return _OPERATOR_ERRORS[blamed]
+            groups[-1].append(0.0)
+        else:
+            groups[-1].append(token)
+
+    if len(groups) == 1:
+        operator_char = _misplaced_operator(groups[0]) or operator_char
+    return _OPERATOR_ERRORS[operator_char]
+
+
+def _misplaced_operator(items):
+    """Find the first operator in a group without the operands it needs.
+
+    Group items as the operators bind, tightest first and left to right
+    among equals, and return the first operator which cannot be grouped,
+    or None. Numbers and closed groups in items are the operands."""
+
+    for level in (['!'], ['^'], ['*', '/'], ['+', '-']):
+        grouped = []
+        rest = iter(items)
+        for item in rest:
+            if item not in level:
+                grouped.append(item)
+                continue
+
+            # A grouped operator and its operands become the operand
+            # already at the end of grouped.
+            if not grouped or grouped[-1].__class__ is str:
+                return item
+            if item != '!' and next(rest, '').__class__ is str:
+                return item
+        items = grouped
+    return None
+
+
+def _emit(program, func):
+    """Append func to a postfix program, folding constant arguments.
+
+    When the arguments func applies to are plain numbers, calculate the
+    result straight away and put it in their place. As every number in
+    an expression is a constant, this leaves a whole expression as a
+    single number."""
+
+    if func is _factorial:
+        if program[-1].__class__ in _NUMBER_CLASSES:
+            program[-1] = func(program[-1])
+            return
+    elif (len(program) >= 2 and program[-1].__class__ in _NUMBER_CLASSES
+            and program[-2].__class__ in _NUMBER_CLASSES):
+        right = program.pop()
+        program[-1] = func(program[-1], right)
+        return
+
+    program.append(func)
+
 
+def evaltree(program):
+    """Evaluate a program created by buildtree.
 
-def evaltree(expr):
-    """Evaluate a tree created by buildtree.
+    Recieve a flat list of numbers and function objects in postfix
+    order. Walk it once with a stack of intermediate values: push each
+    number, and replace the values on top of the stack with the result
+    of each function applied to them. Functions with either one or two
+    arguments are supported; the only one-argument function is the
+    factorial."""
 
-    Recieve a list including, at minimum, a function object and the
-    correct number of arguments to pass to that function. Any or all of
-    the arguments in the list may be lists as well, with the same
-    criteria. Lists may be nested to an arbitrary depth; evaluate
-    the innermost function first, and pass its value up the chain.
-    Functions with either one or two arguments (i.e. 2- or 3-element
-    lists) are supported."""
+    # buildtree folds constant sub-expressions, so a program for plain
+    # arithmetic is already a single number with nothing left to run.
+    if len(program) == 1 and program[0].__class__ in _NUMBER_CLASSES:
+        return program[0]
 
-    # base case: argument is a float.
-    if type(expr) == float:
-        return expr
-    elif len(expr) == 1 and type(expr[0]) == float:
-        return expr[0]
+    # Every number in a program is exactly a float or an int, so its
+    # class is enough to tell numbers from functions.
+    stack = []
+    for item in program:
+        if item.__class__ in _NUMBER_CLASSES:
+            stack.append(item)
+        elif item is _factorial:
+            stack[-1] = item(stack[-1])
+        else:
+            right = stack.pop()
+            stack[-1] = item(stack[-1], right)
 
-    # recursive case: argument is a tree.
-    elif len(expr) == 1 and type(expr[0]) == list:
-        return evaltree(expr[0])
-    elif len(expr) == 2:
-        return expr[0](evaltree(expr[1]))  # Better be a factorial.
-    elif len(expr) == 3:
-        return expr[0](evaltree(expr[1]), evaltree(expr[2]))
-    else:
-        raise(ValueError("evaltree received a list with an invalid length."))
+    if len(stack) != 1:
+        raise(ValueError("evaltree received an incomplete program."))
+    return stack[0]
 
 
+@functools.lru_cache(maxsize=4096)
 def calc(mystring):
-    """Get the numerical value of a string of arithmetic."""
+    """Get the numerical value of a string of arithmetic.
+
+    Results are cached, so calculating the same expression again returns
+    straight away."""
     return(evaltree(buildtree(tokenize(mystring))))
 
 
@@ -269,7 +433,7 @@ Use Control-C or type "exit" to exit this program."""
 
     print(usage)
     while True:
-        user_string = raw_input('ahcalc: ')
+        user_string = input('ahcalc: ')
         if user_string == '':
             continue
         elif user_string in ('q', 'quit', 'exit'):
@@ -279,7 +443,7 @@ Use Control-C or type "exit" to exit this program."""
             continue
 
         try:
-            result = calc(user_string)
+            result = _format_result(calc(user_string))
         except OverflowError:
             print("Incalculable! Wow, that's a really big number! You "
                   "probably can't use a number that large, anyway. Try "
@@ -289,13 +453,29 @@ Use Control-C or type "exit" to exit this program."""
         except ValueError as e:
             print(e)
             continue
-        if int(result) == result:
-            result = int(result)
         print(result)
 
 
+def _format_result(result):
+    """Format a calculated value for printing at the prompt.
+
+    Whole numbers are printed without a decimal point. Python refuses to
+    write out integers with thousands of digits, so those are given in
+    scientific notation instead."""
+
+    if result.__class__ is float:
+        if not result.is_integer():
+            return str(result)
+        result = int(result)
+
+    try:
+        return str(result)
+    except ValueError:
+        return format(decimal.Decimal(result), '.15e')
+
+
 def die(message="Bye!"):
-    exit(message)
+    sys.exit(message)
 
 if __name__ == '__main__':
     try: